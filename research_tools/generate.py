@@ -38,7 +38,7 @@ import os
 import numpy as np
 from matplotlib import pyplot as plt
 
-from util import merge_coco, eval_coco
+from util import merge_coco, eval_coco, dump_coco
 
 
 def make_parser():
@@ -131,6 +131,20 @@ def make_parser():
         action="store_true",
         help="Disable Masked Reinference (for paper metrics)",
     )
+    parser.add_argument(
+        "--auto-workers",
+        dest="auto_workers",
+        default=False,
+        action="store_true",
+        help="Use at least (CPU cores / GPUs) DataLoader workers per rank (naiive strategies only)",
+    )
+    parser.add_argument(
+        "--compile",
+        dest="compile",
+        default=False,
+        action="store_true",
+        help="Compile the model with torch.compile (naiive strategies only, requires PyTorch 2.0+)",
+    )
     parser.add_argument(
         "opts",
         help="Modify config options using the command-line",
@@ -202,6 +216,18 @@ def main(exp, args, num_gpu):
     model.load_state_dict(ckpt["model"])
     logger.info("loaded checkpoint done.")
 
+    if args.compile:
+        assert args.strategy in ["naiive", "naiive-advanced"], "--compile only supports naiive strategies."
+        assert hasattr(torch, "compile"), "--compile requires PyTorch 2.0 or later."
+        # Generator는 conf thresh마다 새로 만들어지므로 model은 여기서 한 번만 compile한다.
+        rank_batch_size = args.batch_size // world_size if is_distributed else args.batch_size
+        model = compile_model(exp, model, rank_batch_size, args.fp16)
+
+    if args.auto_workers:
+        assert args.strategy in ["naiive", "naiive-advanced"], "--auto-workers only supports naiive strategies."
+        # Preprocessing 비용이 model보다 큰 경우가 많으므로, rank당 CPU core 수만큼 worker를 사용한다.
+        exp.data_num_workers = max(exp.data_num_workers, (os.cpu_count() or 1) // world_size)
+
     oneshot_image_ids = None
     if args.image_ids:
         logger.info("Forcing data_num_workers to 0")
@@ -407,6 +433,22 @@ def generate(exp, model, args, is_distributed, rank, world_size, oneshot_image_i
     return coco_result
 
 
+def compile_model(exp, model, batch_size, half_precision):
+    # 입력 shape가 고정인 경우 torch.compile로 layer별 Python dispatch를 줄인다.
+    # Compile 비용을 inference loop 밖에서 미리 치르도록 generator와 같은 shape의 dummy 입력으로 warmup한다.
+    logger.info("Compiling model ...")
+    model = model.to(memory_format=torch.channels_last)
+    model = torch.compile(model, mode="reduce-overhead")
+
+    dummy = torch.zeros((batch_size, 3, *exp.test_size), device=next(model.parameters()).device)
+    dummy = dummy.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode():
+        with torch.cuda.amp.autocast(enabled=half_precision, dtype=torch.float16):
+            model(dummy)
+    torch.cuda.synchronize()
+    return model
+
+
 def build_generator(exp, model, args, is_distributed, oneshot_image_ids, scales):
     # Generate annotation with given model
     if args.strategy == 'naiive':
@@ -421,7 +463,8 @@ def build_generator(exp, model, args, is_distributed, oneshot_image_ids, scales)
                                     is_distributed=is_distributed,
                                     batch_size=args.batch_size,
                                     half_precision=args.fp16,
-                                    oneshot_image_ids=oneshot_image_ids)
+                                    oneshot_image_ids=oneshot_image_ids,
+                                    static_batch_size=args.compile)
 
     elif args.strategy == 'naiive-advanced':
         perclass_conf_ious = [float(v) for v in args.perclass_conf_ious.split(',')]
@@ -448,7 +491,8 @@ def build_generator(exp, model, args, is_distributed, oneshot_image_ids, scales)
                                             batch_size=args.batch_size,
                                             half_precision=args.fp16,
                                             perclass_conf_ious=perclass_conf_ious,
-                                            oneshot_image_ids=oneshot_image_ids)
+                                            oneshot_image_ids=oneshot_image_ids,
+                                            static_batch_size=args.compile)
 
     elif args.strategy == 'iou':
         print("[iou] Generating using Confidence {:.2f} and NMS-IoU {:.2f}".format(args.conf, args.nms))
@@ -512,8 +556,8 @@ def build_generator(exp, model, args, is_distributed, oneshot_image_ids, scales)
 def visualize(exp, args, coco_result, oneshot_image_ids, save_dir=None, image_title=None):
     # 결과 표출 (임시 JSON 파일 활용)
     fp, fileloc = tempfile.mkstemp(suffix=".json")
-    with open(fp, 'w') as f:
-        json.dump(coco_result, f)
+    os.close(fp)
+    dump_coco(coco_result, fileloc)
 
     extra_args = []
     if save_dir is not None:
@@ -539,15 +583,13 @@ def visualize(exp, args, coco_result, oneshot_image_ids, save_dir=None, image_ti
 
 
 def save_result(output_path, coco_result):
-    with open(output_path, 'w') as f:
-        json.dump(coco_result, f)
+    dump_coco(coco_result, output_path)
     logger.info("File saved to {}".format(output_path))
 
 
 def reduce_coco_result(rank, world_size, output_path, coco_result, to_rank=0):
     # Save each rank into separate file
-    with open(output_path + '.r{}.tmp'.format(rank), 'w') as f:
-        json.dump(coco_result, f)
+    dump_coco(coco_result, output_path + '.r{}.tmp'.format(rank))
 
     # Merge all rank's result into single json file
     dist.barrier()  # Make sure all rank wrote json file
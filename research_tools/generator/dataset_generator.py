@@ -48,6 +48,9 @@ class DatasetGenerator(object):
         with open(annotation_path, 'r') as f:
             self.annotations = json.load(f)
 
+        # Create imageid to image mapping table
+        self.images_map = {item['id']: item for item in self.annotations['images']}
+
         # Create imageid to annotation mapping table
         self.annotation_map = {}
         for annotation in self.annotations['annotations']:
@@ -56,6 +59,15 @@ class DatasetGenerator(object):
                 self.annotation_map[image_id] = []
             self.annotation_map[image_id].append(annotation)
 
+    def _assemble_annotations(self, result_annotations, result_image_names):
+        # 생성된 annotation(dict의 list 또는 CocoAnnotations)과 결과가 있는 image id 목록으로 COCO 형식 결과를 만든다.
+        return {
+            "images": [self.images_map[image_id] for image_id in result_image_names],
+            "type": "instances",
+            "annotations": result_annotations,
+            "categories": self.annotations["categories"]
+        }
+
     def init(self):
         raise NotImplementedError()
 
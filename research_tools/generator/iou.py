@@ -9,7 +9,7 @@ from yolox.utils import postprocess
 from yolox.utils.dist import get_local_rank, get_world_size, wait_for_the_master
 
 from .dataset_generator import DatasetGenerator
-from .util import collate_fn, xywh2xyminmax, classid2cocoid, cocoid2classid, iou_np, ValDataPrefetcher
+from .util import collate_fn_infer, classid2cocoid, cocoid2classid, iou_np, annotation_bboxes, ValDataPrefetcher
 
 
 def find_iou_matching_np(bbox: np.ndarray, o_bboxes: np.ndarray, iou_thresh: float):
@@ -82,7 +82,7 @@ class IOUGenerator(DatasetGenerator):
             "num_workers": self.exp.data_num_workers,
             "pin_memory": True,
             "sampler": sampler,
-            "collate_fn": collate_fn,
+            "collate_fn": collate_fn_infer,
         }
         dataloader_kwargs["batch_size"] = self.batch_size
         self.dataloader = torch.utils.data.DataLoader(dataset, **dataloader_kwargs)
@@ -140,31 +140,25 @@ class IOUGenerator(DatasetGenerator):
             pbar.update()
 
         # JSON Annotation 저장하기
-        images_map = {item['id']: item for item in self.annotations['images']}
         result_annotations = []
         for image_id, bboxes in tqdm(results, desc="Organizing result bboxes"):
             for class_id in bboxes.keys():
-                class_bboxes = bboxes[class_id]
-                for bbox in class_bboxes:
-                    bbox = [int(i) for i in bbox]  # np.int64 items does present
-                    bbox = [bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1]]  # xyminmax2xywh
+                # 원소별 int() 변환 대신 배열 단위로 변환한 다음 tolist()로 Python 값을 한 번에 얻는다.
+                class_bboxes, class_areas = annotation_bboxes(bboxes[class_id])  # xyminmax2xywh
+                category_id = int(classid2cocoid(class_id))
+                for bbox, area in zip(class_bboxes.tolist(), class_areas.tolist()):
                     result_annotations.append({
-                        'area': bbox[2] * bbox[3],
+                        'area': area,
                         'iscrowd': 0,
                         'bbox': bbox,
-                        'category_id': int(classid2cocoid(class_id)),
+                        'category_id': category_id,
                         'ignore': 0,
                         'segmentation': [],
                         'image_id': image_id,
                         'id': len(result_annotations) + 1  # 1부터 시작한다.
                     })
 
-        return {
-            "images": [images_map[image_id] for image_id, bboxes in results],
-            "type": "instances",
-            "annotations": result_annotations,
-            "categories": self.annotations["categories"]
-        }
+        return self._assemble_annotations(result_annotations, [image_id for image_id, bboxes in results])
 
     def iou_match(self, image_name, bboxes, cls, scores):
         if image_name not in self.annotation_map:
@@ -174,8 +168,8 @@ class IOUGenerator(DatasetGenerator):
             o_items = self.annotation_map[image_name]
 
         o_cls = np.array(list(map(lambda item: cocoid2classid(item['category_id']), o_items))).astype(int)
-        o_bboxes = np.array(list(map(lambda item: item['bbox'], o_items)))
-        o_bboxes = np.array(list(map(xywh2xyminmax, o_bboxes)))
+        o_bboxes = np.array([item['bbox'] for item in o_items], dtype=np.float64).reshape(-1, 4)
+        o_bboxes[:, 2:] += o_bboxes[:, :2]  # xywh2xyminmax
 
         matched_objects = {}
         infer_nonmatched_objects = {}
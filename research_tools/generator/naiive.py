@@ -1,19 +1,38 @@
 import torch
 import torch.utils.data
 import torch.utils.data.distributed
-import json
+import torchvision
 from tqdm.auto import tqdm
 from loguru import logger
 
-from yolox.utils import postprocess
 from yolox.utils.dist import get_local_rank, get_world_size, wait_for_the_master
 
 from .dataset_generator import DatasetGenerator
-from .util import collate_fn, classid2cocoid, ValDataPrefetcher
+from .util import (collate_fn_infer, outputs_to_numpy, CocoAnnotations, ValDataPrefetcher, decode_predictions,
+                   gather_detections, group_order, grouped_nms, split_detections)
 
 
 class NaiiveGenerator(DatasetGenerator):
 
+    def __init__(self,
+                 exp,
+                 model,
+                 device,
+                 is_distributed,
+                 batch_size,
+                 half_precision,
+                 oneshot_image_ids=None,
+                 static_batch_size=False):
+        super().__init__(exp=exp,
+                         model=model,
+                         device=device,
+                         is_distributed=is_distributed,
+                         batch_size=batch_size,
+                         half_precision=half_precision,
+                         oneshot_image_ids=oneshot_image_ids)
+
+        self.static_batch_size = static_batch_size
+
     def init(self):
         from yolox.data import (ValTransform, COCODataset)
         import torch.distributed as dist
@@ -42,15 +61,46 @@ class NaiiveGenerator(DatasetGenerator):
             "num_workers": self.exp.data_num_workers,
             "pin_memory": True,
             "sampler": sampler,
-            "collate_fn": collate_fn,
+            "collate_fn": collate_fn_infer,
+            "drop_last": False,
         }
         dataloader_kwargs["batch_size"] = self.batch_size
+        if self.exp.data_num_workers > 0:
+            # 미리 읽어두는 batch 수를 늘린다. DataLoader는 한 번만 순회하므로 worker는 유지하지 않는다.
+            dataloader_kwargs["prefetch_factor"] = 4
         self.dataloader = torch.utils.data.DataLoader(dataset, **dataloader_kwargs)
 
+        # cuDNN의 NHWC (Tensor Core) conv kernel을 사용하도록 channels_last로 바꾼다.
+        self.model = self.model.to(memory_format=torch.channels_last)
+
+    def _pad_batch(self, img):
+        # static_batch_size인 경우 (torch.compile된 model) 마지막 batch를 batch_size로 채워서
+        # warmup한 shape와 다른 입력으로 다시 compile되지 않도록 한다. 채운 부분의 결과는 버린다.
+        num_images = len(img)
+        if self.static_batch_size and num_images < self.batch_size:
+            padding = img.new_zeros((self.batch_size - num_images, *img.shape[1:]))
+            img = torch.cat((img, padding), dim=0)
+        return img.contiguous(memory_format=torch.channels_last), num_images
+
+    def _resize_ratios(self, img_info, device):
+        # 배치 전체의 resize ratio를 한 번에 계산하여 GPU로 옮긴다.
+        ratios = torch.minimum(self.exp.test_size[0] / img_info[0], self.exp.test_size[1] / img_info[1])
+        return ratios.to(device, non_blocking=True)
+
+    @staticmethod
+    def _append_outputs(outputs, img_id, result_annotations, result_image_names):
+        # Batch마다 바로 annotation 배열로 변환하여 마지막에 별도로 한 번 더 순회하지 않도록 한다.
+        batch_idxs = [batch_idx for batch_idx, output in enumerate(outputs) if output is not None]
+        if len(batch_idxs) == 0:
+            return
+
+        bboxes, cls, scores = zip(*[outputs[batch_idx] for batch_idx in batch_idxs])
+        image_names = [img_id[batch_idx] for batch_idx in batch_idxs]
+        result_annotations.append(CocoAnnotations.from_per_image(bboxes, cls, scores, image_names))
+        result_image_names.extend(image_names)
+
     def generate_dataset(self):
-        result_bboxes = []
-        result_cls = []
-        result_scores = []
+        result_annotations = []
         result_image_names = []
 
         if self.is_distributed:
@@ -65,65 +115,27 @@ class NaiiveGenerator(DatasetGenerator):
             if isinstance(img, type(None)):  # Can't use 'is None' because it's multidimension Tensor!
                 break  # End of prefetcher
 
-            if self.half_precision:
-                img = img.to(torch.float16)
+            img, num_images = self._pad_batch(img)
 
             # Infer current scale
-            with torch.no_grad():
-                batched_outputs = self.model(img)
-                batched_outputs = postprocess(batched_outputs,
-                                              self.exp.num_classes,
-                                              self.exp.test_conf,
-                                              self.exp.nmsthre,
-                                              class_agnostic=True)
-
-            for batch_idx, output in enumerate(batched_outputs):
-                if output is None:
-                    continue
-
-                ratio = min(self.exp.test_size[0] / img_info[0][batch_idx],
-                            self.exp.test_size[1] / img_info[1][batch_idx])
-
-                bboxes = output[:, 0:4]
-                # preprocessing: resize
-                bboxes /= ratio
-                cls = output[:, 6]
-                scores = output[:, 4] * output[:, 5]
+            # FP16은 autocast로 수행하며, NMS 수치가 달라지지 않도록 postprocess는 FP32로 수행한다.
+            with torch.inference_mode():
+                with torch.cuda.amp.autocast(enabled=self.half_precision, dtype=torch.float16):
+                    batched_outputs = self.model(img)[:num_images]
+                batched_outputs = postprocess_fast(batched_outputs.float(), self.exp.num_classes, self.exp.test_conf,
+                                                   self.exp.nmsthre)
 
-                result_bboxes.append(bboxes.cpu().numpy())
-                result_cls.append(cls.cpu().numpy().astype(int))
-                result_scores.append(scores.cpu().numpy())
-                result_image_names.append(img_id[batch_idx])
+                # preprocessing: resize
+                # resize는 GPU에서 수행하고, 배치 전체 결과를 한 번에 CPU로 옮긴다.
+                ratios = self._resize_ratios(img_info, img.device)
+                self._append_outputs(outputs_to_numpy(batched_outputs, ratios), img_id, result_annotations,
+                                     result_image_names)
 
             pbar.update()
 
         # JSON Annotation 저장하기
-        images_map = {item['id']: item for item in self.annotations['images']}
-        result_annotations = []
-        for bboxes, cls, scores, image_id in tqdm(zip(result_bboxes, result_cls, result_scores, result_image_names),
-                                                  desc="Organizing result bboxes",
-                                                  total=len(result_bboxes)):
-            for bbox, cls, score in zip(bboxes, cls, scores):
-                bbox = [int(i) for i in bbox]  # np.int64 items does present
-                bbox = [bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1]]  # xyminmax2xywh
-                result_annotations.append({
-                    'area': bbox[2] * bbox[3],
-                    'iscrowd': 0,
-                    'bbox': bbox,
-                    'category_id': int(classid2cocoid(cls)),
-                    'det_confidence': float(score),
-                    'ignore': 0,
-                    'segmentation': [],
-                    'image_id': image_id,
-                    'id': len(result_annotations) + 1  # 1부터 시작한다.
-                })
-
-        return {
-            "images": [images_map[image_id] for image_id in result_image_names],
-            "type": "instances",
-            "annotations": result_annotations,
-            "categories": self.annotations["categories"]
-        }
+        # Annotation은 column별 배열로 들고 있다가 저장할 때 하나씩 dict로 만든다.
+        return self._assemble_annotations(CocoAnnotations.concatenate(result_annotations), result_image_names)
 
 
 class NaiiveAdvancedGenerator(NaiiveGenerator):
@@ -136,21 +148,21 @@ class NaiiveAdvancedGenerator(NaiiveGenerator):
                  batch_size,
                  half_precision,
                  perclass_conf_ious,
-                 oneshot_image_ids=None):
+                 oneshot_image_ids=None,
+                 static_batch_size=False):
         super().__init__(exp=exp,
                          model=model,
                          device=device,
                          is_distributed=is_distributed,
                          batch_size=batch_size,
                          half_precision=half_precision,
-                         oneshot_image_ids=oneshot_image_ids)
+                         oneshot_image_ids=oneshot_image_ids,
+                         static_batch_size=static_batch_size)
 
         self.perclass_conf_ious = perclass_conf_ious
 
     def generate_dataset(self):
-        result_bboxes = []
-        result_cls = []
-        result_scores = []
+        result_annotations = []
         result_image_names = []
 
         if self.is_distributed:
@@ -158,95 +170,87 @@ class NaiiveAdvancedGenerator(NaiiveGenerator):
         else:
             desc_msg = "Inferencing"
 
-        for total_batch_idx, (img, target, img_info, img_id) in tqdm(enumerate(self.dataloader),
-                                                                     desc=desc_msg,
-                                                                     total=len(self.dataloader)):
-            if self.device == 'gpu':
-                img = img.cuda()
-            if self.half_precision:
-                img = img.half()
+        conf_thresh_vec = torch.tensor([conf_thresh for conf_thresh, _ in self.perclass_conf_ious], device='cuda')
+        iou_thresh_vec = torch.tensor([iou_thresh for _, iou_thresh in self.perclass_conf_ious],
+                                      dtype=torch.float64,
+                                      device='cuda')
+
+        # 다음 batch의 H2D 전송을 별도 stream에서 미리 수행하여 현재 batch의 inference와 겹치도록 한다.
+        prefetcher = ValDataPrefetcher(self.dataloader)
+        pbar = tqdm(range(len(self.dataloader)), desc=desc_msg)
+        while True:
+            img, target, img_info, img_id = prefetcher.next()
+            if isinstance(img, type(None)):  # Can't use 'is None' because it's multidimension Tensor!
+                break  # End of prefetcher
+
+            img, num_images = self._pad_batch(img)
 
             # Infer current scale
-            with torch.no_grad():
-                batched_outputs = self.model(img)
-
-                result_boxes_map = {}
-                result_cls_map = {}
-                result_scores_map = {}
-
-                for class_id in range(self.exp.num_classes):
-                    conf_thresh, iou_thresh = self.perclass_conf_ious[class_id]
-
-                    per_class_batched_outputs = postprocess(batched_outputs,
-                                                            self.exp.num_classes,
-                                                            conf_thresh,
-                                                            iou_thresh,
-                                                            class_agnostic=True)
-
-                    for batch_idx, output in enumerate(per_class_batched_outputs):
-                        if output is None:
-                            continue
-
-                        ratio = min(self.exp.test_size[0] / img_info[0][batch_idx],
-                                    self.exp.test_size[1] / img_info[1][batch_idx])
-
-                        bboxes = output[:, 0:4]
-                        # preprocessing: resize
-                        bboxes /= ratio
-                        cls = output[:, 6]
-                        scores = output[:, 4] * output[:, 5]
-
-                        bboxes = bboxes.cpu().numpy()
-                        cls = cls.cpu().numpy().astype(int)
-                        scores = scores.cpu().numpy()
-
-                        class_mask = cls == class_id
-                        bboxes = bboxes[class_mask]
-                        cls = cls[class_mask]
-                        scores = scores[class_mask]
-
-                        image_name = img_id[batch_idx]
-
-                        if len(bboxes) > 0:
-                            if image_name not in result_boxes_map:
-                                result_boxes_map[image_name] = []
-                                result_cls_map[image_name] = []
-                                result_scores_map[image_name] = []
-
-                            result_boxes_map[image_name].extend(bboxes)
-                            result_cls_map[image_name].extend(cls)
-                            result_scores_map[image_name].extend(scores)
-
-                for image_id in result_boxes_map.keys():
-                    result_bboxes.append(result_boxes_map[image_id])
-                    result_cls.append(result_cls_map[image_id])
-                    result_scores.append(result_scores_map[image_id])
-                    result_image_names.append(image_id)
+            # FP16은 autocast로 수행하며, NMS 수치가 달라지지 않도록 postprocess는 FP32로 수행한다.
+            with torch.inference_mode():
+                with torch.cuda.amp.autocast(enabled=self.half_precision, dtype=torch.float16):
+                    batched_outputs = self.model(img)[:num_images]
+                batched_outputs = postprocess_perclass(batched_outputs.float(), self.exp.num_classes, conf_thresh_vec,
+                                                       iou_thresh_vec)
+
+                # preprocessing: resize
+                # resize는 GPU에서 수행하고, 배치 전체 결과를 한 번에 CPU로 옮긴다.
+                ratios = self._resize_ratios(img_info, img.device)
+                self._append_outputs(outputs_to_numpy(batched_outputs, ratios), img_id, result_annotations,
+                                     result_image_names)
+
+            pbar.update()
 
         # JSON Annotation 저장하기
-        images_map = {item['id']: item for item in self.annotations['images']}
-        result_annotations = []
-        for bboxes, cls, scores, image_id in tqdm(zip(result_bboxes, result_cls, result_scores, result_image_names),
-                                                  desc="Organizing result bboxes",
-                                                  total=len(result_bboxes)):
-            for bbox, cls, score in zip(bboxes, cls, scores):
-                bbox = [int(i) for i in bbox]  # np.int64 items does present
-                bbox = [bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1]]  # xyminmax2xywh
-                result_annotations.append({
-                    'area': bbox[2] * bbox[3],
-                    'iscrowd': 0,
-                    'bbox': bbox,
-                    'category_id': int(classid2cocoid(cls)),
-                    'det_confidence': score,
-                    'ignore': 0,
-                    'segmentation': [],
-                    'image_id': image_id,
-                    'id': len(result_annotations) + 1  # 1부터 시작한다.
-                })
-
-        return {
-            "images": [images_map[image_id] for image_id in result_image_names],
-            "type": "instances",
-            "annotations": result_annotations,
-            "categories": self.annotations["categories"]
-        }
\ No newline at end of file
+        # Annotation은 column별 배열로 들고 있다가 저장할 때 하나씩 dict로 만든다.
+        return self._assemble_annotations(CocoAnnotations.concatenate(result_annotations), result_image_names)
+
+
+def postprocess_fast(prediction, num_classes, conf_thre, nms_thre):
+    # yolox.utils.postprocess(class_agnostic=True)와 같은 결과를 이미지별 Python loop 없이 구한다.
+    # 반환값은 이미지별 detection (x1, y1, x2, y2, obj_conf, class_conf, class_pred)이며, score 순이다.
+    box_corner, class_conf, class_pred, scores = decode_predictions(prediction, num_classes)
+    batch_idx, det_idx = (scores >= conf_thre).nonzero(as_tuple=True)
+
+    # batch_idx를 group으로 사용하여 이미지별 class agnostic NMS를 수행한다.
+    keep = grouped_nms(box_corner[batch_idx, det_idx], scores[batch_idx, det_idx], batch_idx, float(nms_thre))
+    batch_idx, det_idx = batch_idx[keep], det_idx[keep]
+
+    detections = gather_detections(prediction, box_corner, class_conf, class_pred, batch_idx, det_idx)
+    return split_detections(detections, batch_idx, prediction.size(0))
+
+
+def postprocess_perclass(prediction, num_classes, conf_thresh_vec, iou_thresh_vec):
+    # Class별 (conf_thresh, iou_thresh)로 class agnostic postprocess를 수행한 다음 해당 class 결과만 남기는 것을
+    # class 수만큼 postprocess를 반복하지 않고 한 번에 수행한다.
+    # Class agnostic NMS이므로 다른 class의 bbox도 suppress에 참여한다. 따라서 (이미지, class) 그룹마다
+    # 해당 class의 conf_thresh를 넘는 모든 bbox를 후보로 두고 그룹 단위로 batched_nms를 수행한다.
+    # batched_nms의 IoU threshold는 하나이므로, 서로 다른 iou_thresh 값마다 한 번씩 수행한다.
+    # 단, batched_nms는 입력 bbox가 많으면 (GPU에서 boxes.numel() > 20000, torchvision 버전에 따라 다름) 그룹마다
+    # nms를 호출하므로, conf_thresh가 낮으면 NMS 호출 수는 여전히 (이미지 수 x class 수)가 될 수 있다.
+    # 반환값은 이미지별 detection (x1, y1, x2, y2, obj_conf, class_conf, class_pred)이며, class 순 -> score 순이다.
+    box_corner, class_conf, class_pred, scores = decode_predictions(prediction, num_classes)
+
+    # (batch, detection, class) 후보 mask. 해당 class의 bbox가 하나도 없는 그룹은 결과가 없으므로 제외한다.
+    candidates = scores.unsqueeze(-1) >= conf_thresh_vec.to(scores.dtype)
+    is_target_class = class_pred.unsqueeze(-1) == torch.arange(num_classes, device=class_pred.device)
+    candidates &= torch.any(candidates & is_target_class, dim=1, keepdim=True)
+    batch_idx, det_idx, group_class = candidates.nonzero(as_tuple=True)
+    groups = batch_idx * num_classes + group_class
+
+    keep = []
+    for iou_thresh in torch.unique(iou_thresh_vec).tolist():
+        thresh_idxs = torch.nonzero(iou_thresh_vec[group_class] == iou_thresh).squeeze(1)
+        thresh_keep = torchvision.ops.batched_nms(box_corner[batch_idx[thresh_idxs], det_idx[thresh_idxs]],
+                                                  scores[batch_idx[thresh_idxs], det_idx[thresh_idxs]],
+                                                  groups[thresh_idxs], iou_thresh)
+        keep.append(thresh_idxs[thresh_keep])
+    keep = torch.cat(keep)
+
+    # 그룹의 class에 해당하는 bbox만 남기고, (이미지, class) 순 -> score 순으로 정렬한다.
+    keep = keep[class_pred[batch_idx[keep], det_idx[keep]] == group_class[keep]]
+    keep = keep[group_order(scores[batch_idx[keep], det_idx[keep]], groups[keep])]
+    batch_idx, det_idx = batch_idx[keep], det_idx[keep]
+
+    detections = gather_detections(prediction, box_corner, class_conf, class_pred, batch_idx, det_idx)
+    return split_detections(detections, batch_idx, prediction.size(0))
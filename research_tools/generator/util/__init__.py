@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
 from .util import *
 from .iou import *
-from .dataloader import *
\ No newline at end of file
+from .dataloader import *
+from .rematch import *
+from .annotation import *
+from .postprocess import *
\ No newline at end of file
@@ -0,0 +1,102 @@
+import numpy as np
+
+from .util import classid2cocoid
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def annotation_bboxes(bboxes):
+    # (N, 4) xyminmax bbox를 COCO annotation용 정수 xywh bbox와 area로 변환한다.
+    # 정수 변환은 int()와 같이 0 방향으로 버림하며, area는 정수 w * h이다.
+    bboxes = np.ascontiguousarray(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4))
+    if NUMBA_AVAILABLE:
+        return _annotation_bboxes_kernel(bboxes)
+    return _annotation_bboxes_np(bboxes)
+
+
+def _annotation_bboxes_np(bboxes):
+    xywh = bboxes.astype(np.int64)
+    xywh[:, 2:] -= xywh[:, :2]  # xyminmax2xywh
+    return xywh, xywh[:, 2] * xywh[:, 3]
+
+
+def _annotation_bboxes_kernel(bboxes):
+    num_bboxes = bboxes.shape[0]
+    xywh = np.empty((num_bboxes, 4), dtype=np.int64)
+    areas = np.empty(num_bboxes, dtype=np.int64)
+    for idx in range(num_bboxes):
+        xmin, ymin = int(bboxes[idx, 0]), int(bboxes[idx, 1])
+        xmax, ymax = int(bboxes[idx, 2]), int(bboxes[idx, 3])
+        xywh[idx, 0] = xmin
+        xywh[idx, 1] = ymin
+        xywh[idx, 2] = xmax - xmin
+        xywh[idx, 3] = ymax - ymin
+        areas[idx] = xywh[idx, 2] * xywh[idx, 3]
+    return xywh, areas
+
+
+if NUMBA_AVAILABLE:
+    # signature를 명시하여 import 시점에 컴파일한다.
+    _annotation_bboxes_kernel = njit("Tuple((i8[:, :], i8[:]))(f8[:, :])", cache=True)(_annotation_bboxes_kernel)
+
+
+class CocoAnnotations(object):
+    # 결과 annotation을 dict의 list 대신 column별 numpy 배열(SoA)로 들고 있는다.
+    # len()과 반복(iteration)을 지원하며, annotation dict는 반복할 때 하나씩 만들어진다.
+    # 따라서 dump_coco로 저장할 때 전체 annotation dict를 한꺼번에 메모리에 올리지 않는다.
+
+    def __init__(self, bboxes, category_ids, scores, image_ids):
+        # bboxes: (N, 4) xyminmax, category_ids: (N,) COCO category id, scores: (N,), image_ids: (N,)
+        self.bboxes, self.areas = annotation_bboxes(bboxes)
+        self.category_ids = np.asarray(category_ids, dtype=np.int64).reshape(-1)
+        self.scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        self.image_ids = np.asarray(image_ids).reshape(-1)
+        assert len(self.bboxes) == len(self.category_ids) == len(self.scores) == len(self.image_ids)
+
+    @classmethod
+    def from_per_image(cls, result_bboxes, result_cls, result_scores, result_image_names):
+        # 이미지별 (bboxes, class_id, scores) 배열과 image id로부터 만든다. class_id는 0부터 시작한다.
+        if len(result_bboxes) == 0:
+            return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64))
+
+        counts = [len(bboxes) for bboxes in result_bboxes]
+        return cls(
+            np.concatenate([np.asarray(bboxes).reshape(-1, 4) for bboxes in result_bboxes]),
+            classid2cocoid(np.concatenate(result_cls).astype(np.int64)),
+            np.concatenate(result_scores),
+            np.repeat(np.asarray(result_image_names), counts),
+        )
+
+    @classmethod
+    def concatenate(cls, annotations_list):
+        # 여러 CocoAnnotations(예: batch별 결과)를 순서대로 하나로 합친다. id는 합친 순서대로 다시 매겨진다.
+        if len(annotations_list) == 0:
+            return cls.from_per_image([], [], [], [])
+
+        result = cls.__new__(cls)
+        for column in ('bboxes', 'areas', 'category_ids', 'scores', 'image_ids'):
+            setattr(result, column, np.concatenate([getattr(annotations, column) for annotations in annotations_list]))
+        return result
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def __iter__(self):
+        columns = zip(self.bboxes.tolist(), self.areas.tolist(), self.category_ids.tolist(), self.scores.tolist(),
+                      self.image_ids.tolist())
+        for idx, (bbox, area, category_id, score, image_id) in enumerate(columns):
+            yield {
+                'area': area,
+                'iscrowd': 0,
+                'bbox': bbox,
+                'category_id': category_id,
+                'det_confidence': score,
+                'ignore': 0,
+                'segmentation': [],
+                'image_id': image_id,
+                'id': idx + 1  # 1부터 시작한다.
+            }
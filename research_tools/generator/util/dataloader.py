@@ -24,7 +24,8 @@ class ValDataPrefetcher:
 
         with torch.cuda.stream(self.stream):
             self.input_cuda()
-            self.next_target = self.next_target.cuda(non_blocking=True)
+            if self.next_target is not None:  # collate_fn_infer는 target을 돌려주지 않는다.
+                self.next_target = self.next_target.cuda(non_blocking=True)
 
     def next(self) -> Tuple[torch.Tensor, torch.Tensor, np.ndarray, np.ndarray]:
         torch.cuda.current_stream().wait_stream(self.stream)
@@ -45,3 +46,19 @@ class ValDataPrefetcher:
     @staticmethod
     def _record_stream_for_image(input):
         input.record_stream(torch.cuda.current_stream())
+
+
+def prefetch_scales(dataloader_map, scales):
+    # scales 순서대로 (scale, ValDataPrefetcher)를 돌려준다.
+    # 현재 scale을 추론하는 동안 다음 scale의 DataLoader worker를 미리 띄워서 이미지를 읽어두도록 한다.
+    # (DataLoader iterator는 iter() 시점에 worker가 prefetch를 시작한다)
+    scales = list(scales)
+    if len(scales) == 0:
+        return
+
+    next_loader_iter = iter(dataloader_map[scales[0]])
+    for scale_idx, scale in enumerate(scales):
+        prefetcher = ValDataPrefetcher(next_loader_iter)
+        if scale_idx + 1 < len(scales):
+            next_loader_iter = iter(dataloader_map[scales[scale_idx + 1]])
+        yield scale, prefetcher
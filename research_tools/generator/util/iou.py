@@ -45,6 +45,24 @@ def iou_np(bbox1: np.ndarray, bbox2: np.ndarray) -> float:
     return inter_vol / union_vol
 
 
+def iou_matrix(bboxes1: np.ndarray, bboxes2: np.ndarray) -> np.ndarray:
+    # (N, 4) x (M, 4) -> (N, M) pairwise IoU, iou_np과 동일한 결과를 한 번에 계산한다.
+    bboxes1 = np.asarray(bboxes1, dtype=np.float64).reshape(-1, 4)
+    bboxes2 = np.asarray(bboxes2, dtype=np.float64).reshape(-1, 4)
+
+    area1 = (bboxes1[:, 2] - bboxes1[:, 0]) * (bboxes1[:, 3] - bboxes1[:, 1])
+    area2 = (bboxes2[:, 2] - bboxes2[:, 0]) * (bboxes2[:, 3] - bboxes2[:, 1])
+
+    inter_w = np.clip(np.minimum(bboxes1[:, None, 2], bboxes2[None, :, 2]) - \
+        np.maximum(bboxes1[:, None, 0], bboxes2[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(bboxes1[:, None, 3], bboxes2[None, :, 3]) - \
+        np.maximum(bboxes1[:, None, 1], bboxes2[None, :, 1]), 0, None)
+    inter_vol = inter_w * inter_h
+    union_vol = area1[:, None] + area2[None, :] - inter_vol
+
+    return inter_vol / union_vol
+
+
 def iou_torch(bbox1: torch.Tensor, bbox2: torch.Tensor):
     w, h = bbox1[2:] - bbox1[:2]
     bbox1_vol = w * h
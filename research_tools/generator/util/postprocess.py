@@ -0,0 +1,57 @@
+import torch
+import torchvision
+from typing import Tuple
+
+# Generator들의 postprocess (decode, conf filter, NMS)가 공유하는 부분이다.
+# 모든 strategy가 같은 함수를 사용하여 NMS 동작이 서로 달라지지 않도록 한다.
+
+
+@torch.jit.script
+def decode_predictions(prediction: torch.Tensor,
+                       num_classes: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    # (batch, detection, 5 + num_classes) model output을 배치 전체에 대해 한 번에 decode한다.
+    # (cx, cy, w, h) -> (x1, y1, x2, y2) bbox와 class_conf, class_pred, score (obj_conf * class_conf)를 반환한다.
+    box_corner = torch.stack([
+        prediction[:, :, 0] - prediction[:, :, 2] / 2,
+        prediction[:, :, 1] - prediction[:, :, 3] / 2,
+        prediction[:, :, 0] + prediction[:, :, 2] / 2,
+        prediction[:, :, 1] + prediction[:, :, 3] / 2,
+    ], dim=-1)
+    class_conf, class_pred = torch.max(prediction[:, :, 5:5 + num_classes], dim=-1)
+    scores = prediction[:, :, 4] * class_conf
+    return box_corner, class_conf, class_pred, scores
+
+
+@torch.jit.script
+def gather_detections(prediction: torch.Tensor, box_corner: torch.Tensor, class_conf: torch.Tensor,
+                      class_pred: torch.Tensor, batch_idx: torch.Tensor, det_idx: torch.Tensor) -> torch.Tensor:
+    # (batch_idx, det_idx) 위치의 detection을 YOLOX postprocess와 같은 (N, 7) 형식으로 모은다.
+    # Detections ordered as (x1, y1, x2, y2, obj_conf, class_conf, class_pred)
+    return torch.cat((
+        box_corner[batch_idx, det_idx],
+        prediction[batch_idx, det_idx, 4:5],
+        class_conf[batch_idx, det_idx].unsqueeze(1),
+        class_pred[batch_idx, det_idx].unsqueeze(1).to(prediction.dtype),
+    ), dim=1)
+
+
+@torch.jit.script
+def group_order(scores: torch.Tensor, groups: torch.Tensor) -> torch.Tensor:
+    # group 순으로 정렬하되 group 내부는 score 내림차순이 되도록 하는 index를 반환한다.
+    # 두 번 모두 stable sort이므로 score가 같으면 입력 순서를 유지한다.
+    order = torch.sort(scores, descending=True, stable=True)[1]
+    return order[torch.sort(groups[order], stable=True)[1]]
+
+
+@torch.jit.script
+def grouped_nms(boxes: torch.Tensor, scores: torch.Tensor, groups: torch.Tensor, nms_thre: float) -> torch.Tensor:
+    # group 단위 NMS를 batched_nms 한 번으로 수행한다. (group에 batch_idx를 넣으면 이미지별 class agnostic NMS)
+    # 남은 index를 group 순 -> score 순으로 반환한다.
+    keep = torchvision.ops.batched_nms(boxes, scores, groups, nms_thre)
+    return keep[group_order(scores[keep], groups[keep])]
+
+
+def split_detections(detections, batch_idx, batch_size):
+    # 이미지별로 다시 나눈다. (batch_idx는 이미지 순으로 정렬되어 있다.)
+    counts = torch.bincount(batch_idx, minlength=batch_size).tolist()
+    return list(torch.split(detections, counts))
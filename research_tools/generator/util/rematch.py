@@ -0,0 +1,238 @@
+import numpy as np
+
+from .iou import iou_matrix
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# multiscale_match에서 flatten된 bbox가 어느 테이블에서 왔는지 나타낸다.
+MATCHED_TAG = 0
+GT_ONLY_TAG = 1
+INFER_ONLY_TAG = 2
+
+
+def rematch_infer_only(bboxes, iou_thresh, rematch_thresh):
+    # Class-inaware per-class rematch infer_only_bbox
+    # infer_only bbox들을 서로 매칭하여 자기 자신 포함 N개(rematch_thresh) 이상 IoU thresh를 넘는 그룹을 찾는다.
+    # 그룹은 infer_only에서 제거되며 (keep=False), 그룹을 만든 src bbox index와 그룹 크기를 반환한다.
+    bboxes = np.ascontiguousarray(np.asarray(bboxes, dtype=np.float64).reshape(-1, 4))
+    if NUMBA_AVAILABLE:
+        return _rematch_infer_only_kernel(bboxes, float(iou_thresh), int(rematch_thresh))
+    return _rematch_infer_only_np(bboxes, iou_thresh, rematch_thresh)
+
+
+def class_aware_rematch(flatten_items, flatten_keep, iou_thresh):
+    # Class-aware rematch (Inner match, Outer match)
+    # flatten_items: (N, 7) [x1, y1, x2, y2, class_id, occurance, origin_tag], flatten_keep: (N, ) bool
+    # 두 배열 모두 in-place로 갱신된다.
+    if NUMBA_AVAILABLE:
+        order, x1_sorted, max_width = _sweep_window(flatten_items, iou_thresh)
+        _class_aware_rematch_kernel(flatten_items, flatten_keep, order.astype(np.int64), x1_sorted, float(max_width),
+                                    float(iou_thresh))
+    else:
+        _class_aware_rematch_np(flatten_items, flatten_keep, iou_thresh)
+
+
+def _rematch_infer_only_np(bboxes, iou_thresh, rematch_thresh):
+    # 전체 pairwise IoU를 미리 계산해두고, 제거된 bbox는 keep에서 내리기만 한다.
+    # alive_idxs는 아직 남아있는 bbox의 원본 index이며, srcbbox_pos는 그 안에서의 위치이다.
+    rematch_ious = iou_matrix(bboxes, bboxes)
+    keep = np.ones(len(bboxes), dtype=bool)
+    alive_idxs = np.arange(len(bboxes))
+    group_src_idxs = []
+    group_sizes = []
+
+    srcbbox_pos = 0
+    while srcbbox_pos < len(alive_idxs):
+        srcbbox_idx = alive_idxs[srcbbox_pos]
+        iou_table = rematch_ious[srcbbox_idx, alive_idxs]  # Include self-bbox on purpose (Will be IoU=1.0)
+
+        iou_argsort = np.argsort(iou_table)
+        if np.all(iou_table[iou_argsort][::-1][:rematch_thresh] >= iou_thresh):
+            # 자기 자신도 들어가 있으므로, Group으로 전부 제거된다.
+            thresh_over_idxs = alive_idxs[iou_table >= iou_thresh]
+            keep[thresh_over_idxs] = False
+            alive_idxs = np.flatnonzero(keep)
+
+            group_src_idxs.append(srcbbox_idx)
+            group_sizes.append(len(thresh_over_idxs))
+        else:
+            srcbbox_pos += 1
+
+    return keep, np.array(group_src_idxs, dtype=np.int64), np.array(group_sizes, dtype=np.int64)
+
+
+def _sweep_window(flatten_items, iou_thresh):
+    # Sweep and prune: x1 기준으로 정렬해두고, 각 bbox와 x축으로 겹칠 수 있는 bbox만 후보로 사용한다.
+    # x1 < origin.x2, x1 > origin.x1 - max_width 이어야 겹칠 수 있다.
+    # iou_thresh가 음수이면 겹치지 않는 bbox도 threshold를 넘으므로 window를 전체로 잡는다.
+    order = np.argsort(flatten_items[:, 0], kind='stable')
+    x1_sorted = np.ascontiguousarray(flatten_items[order, 0])
+    max_width = np.max(flatten_items[:, 2] - flatten_items[:, 0]) if len(flatten_items) > 0 else 0.
+    if iou_thresh < 0:
+        max_width = np.inf
+    return order, x1_sorted, max_width
+
+
+def _class_aware_rematch_np(flatten_items, flatten_keep, iou_thresh):
+    flatten_tags = flatten_items[:, 6]
+    order, x1_sorted, max_width = _sweep_window(flatten_items, iou_thresh)
+
+    for matched_item_idx in np.flatnonzero(flatten_tags == MATCHED_TAG):
+        if not flatten_keep[matched_item_idx]:
+            continue  # 앞선 Inner Match에서 제거됨
+        bbox_origin = flatten_items[matched_item_idx, :4]
+        matched_class_id, matched_class_occurances = flatten_items[matched_item_idx, 4:6]
+
+        lo = np.searchsorted(x1_sorted, bbox_origin[0] - max_width, side='left')
+        hi = np.searchsorted(x1_sorted, bbox_origin[2] if iou_thresh >= 0 else np.inf, side='left')
+        candidates = order[lo:hi]
+        candidates = candidates[flatten_keep[candidates]]
+
+        # Inner Match (Matched->Matched)와 Outer Match (GT|Infer->Matched)를 한 번에 계산한다.
+        iou_table = iou_matrix(bbox_origin, flatten_items[candidates, :4])[0]
+        iou_over = candidates[iou_table > iou_thresh]
+        # 같은 객체는 IoU가 1.0이므로 제외한다. (Inner Match 한정)
+        iou_over = iou_over[~((flatten_tags[iou_over] == MATCHED_TAG) &
+                              np.all(flatten_items[iou_over, :4] == bbox_origin, axis=1))]
+
+        # 지배적인 클래스를 찾아서 현재 박스의 클래스로 세팅한다.
+        # IoU가 같으니 다른 class였어도 같은 bbox에 대한 detection이라고 본다.
+        # 그렇기 때문에 occurance의 합을 occurance count로 전달한다.
+        # 기존 동작과 동일하게 Outer Match 결과만 반영하며, Infer->Matched 결과가 GT->Matched 결과보다 우선한다.
+        for outer_tag in [INFER_ONLY_TAG, GT_ONLY_TAG]:
+            outer_over = iou_over[flatten_tags[iou_over] == outer_tag]
+            if len(outer_over) == 0:
+                continue
+
+            class_counts = np.bincount(np.append(flatten_items[outer_over, 4], matched_class_id).astype(int),
+                                       weights=np.append(flatten_items[outer_over, 5], matched_class_occurances))
+            flatten_items[matched_item_idx, 4] = np.argmax(class_counts)
+            flatten_items[matched_item_idx, 5] = np.sum(class_counts)
+            break
+
+        # 겹치는 박스 모두 지우기
+        flatten_keep[iou_over] = False
+
+
+# 아래 kernel들은 numba로 컴파일되며, 위 NumPy 구현과 동일한 결과를 낸다.
+# IoU는 iou_matrix와 같은 연산 순서로 계산해야 threshold 비교 결과가 달라지지 않는다.
+def _iou_kernel(bbox1, bbox2):
+    area1 = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1])
+    area2 = (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1])
+    inter_w = max(min(bbox1[2], bbox2[2]) - max(bbox1[0], bbox2[0]), 0.)
+    inter_h = max(min(bbox1[3], bbox2[3]) - max(bbox1[1], bbox2[1]), 0.)
+    inter_vol = inter_w * inter_h
+    union_vol = area1 + area2 - inter_vol
+    return inter_vol / union_vol
+
+
+def _rematch_infer_only_kernel(bboxes, iou_thresh, rematch_thresh):
+    num_bboxes = bboxes.shape[0]
+    keep = np.ones(num_bboxes, dtype=np.bool_)
+    group_src_idxs = np.empty(num_bboxes, dtype=np.int64)
+    group_sizes = np.empty(num_bboxes, dtype=np.int64)
+    num_groups = 0
+
+    alive_idxs = np.arange(num_bboxes)
+    num_alive = num_bboxes
+    iou_table = np.empty(num_bboxes, dtype=np.float64)
+
+    srcbbox_pos = 0
+    while srcbbox_pos < num_alive:
+        srcbbox_idx = alive_idxs[srcbbox_pos]
+        num_over = 0
+        has_nan = False
+        for pos in range(num_alive):
+            iou = _iou_kernel(bboxes[srcbbox_idx], bboxes[alive_idxs[pos]])
+            iou_table[pos] = iou
+            if iou >= iou_thresh:
+                num_over += 1
+            elif iou != iou:
+                has_nan = True
+
+        # 상위 rematch_thresh개의 IoU가 모두 thresh를 넘는지 확인한다. (NaN은 argsort에서 가장 앞에 온다)
+        if (rematch_thresh > 0 and has_nan) or num_over < min(rematch_thresh, num_alive):
+            srcbbox_pos += 1
+            continue
+
+        group_src_idxs[num_groups] = srcbbox_idx
+        group_sizes[num_groups] = num_over
+        num_groups += 1
+
+        new_num_alive = 0
+        for pos in range(num_alive):
+            if iou_table[pos] >= iou_thresh:
+                keep[alive_idxs[pos]] = False
+            else:
+                alive_idxs[new_num_alive] = alive_idxs[pos]
+                new_num_alive += 1
+        num_alive = new_num_alive
+
+    return keep, group_src_idxs[:num_groups], group_sizes[:num_groups]
+
+
+def _class_aware_rematch_kernel(flatten_items, flatten_keep, order, x1_sorted, max_width, iou_thresh):
+    num_items = flatten_items.shape[0]
+    over_idxs = np.empty(num_items, dtype=np.int64)
+
+    max_class_id = 0
+    for idx in range(num_items):
+        max_class_id = max(max_class_id, int(flatten_items[idx, 4]))
+    class_counts = np.zeros(max_class_id + 1, dtype=np.float64)
+
+    for matched_item_idx in range(num_items):
+        if flatten_items[matched_item_idx, 6] != MATCHED_TAG or not flatten_keep[matched_item_idx]:
+            continue
+        bbox_origin = flatten_items[matched_item_idx, :4]
+
+        lo = np.searchsorted(x1_sorted, bbox_origin[0] - max_width)
+        hi = np.searchsorted(x1_sorted, bbox_origin[2] if iou_thresh >= 0 else np.inf)
+
+        num_over = 0
+        has_gt_over = False
+        has_infer_over = False
+        for pos in range(lo, hi):
+            idx = order[pos]
+            if not flatten_keep[idx]:
+                continue
+            if not _iou_kernel(bbox_origin, flatten_items[idx, :4]) > iou_thresh:
+                continue
+
+            origin_tag = flatten_items[idx, 6]
+            if origin_tag == MATCHED_TAG:
+                if flatten_items[idx, 0] == bbox_origin[0] and flatten_items[idx, 1] == bbox_origin[1] and \
+                        flatten_items[idx, 2] == bbox_origin[2] and flatten_items[idx, 3] == bbox_origin[3]:
+                    continue  # 같은 객체는 IoU가 1.0이므로 제외한다.
+            elif origin_tag == GT_ONLY_TAG:
+                has_gt_over = True
+            else:
+                has_infer_over = True
+            over_idxs[num_over] = idx
+            num_over += 1
+
+        outer_tag = INFER_ONLY_TAG if has_infer_over else GT_ONLY_TAG
+        if has_infer_over or has_gt_over:
+            class_counts[:] = 0.
+            for pos in range(num_over):
+                idx = over_idxs[pos]
+                if flatten_items[idx, 6] == outer_tag:
+                    class_counts[int(flatten_items[idx, 4])] += flatten_items[idx, 5]
+            class_counts[int(flatten_items[matched_item_idx, 4])] += flatten_items[matched_item_idx, 5]
+            flatten_items[matched_item_idx, 4] = np.argmax(class_counts)
+            flatten_items[matched_item_idx, 5] = np.sum(class_counts)
+
+        for pos in range(num_over):
+            flatten_keep[over_idxs[pos]] = False
+
+
+if NUMBA_AVAILABLE:
+    # 이미지마다 JIT warmup이 발생하지 않도록 signature를 명시하여 import 시점에 컴파일한다.
+    _iou_kernel = njit("f8(f8[:], f8[:])", cache=True)(_iou_kernel)
+    _rematch_infer_only_kernel = njit("Tuple((b1[:], i8[:], i8[:]))(f8[:, :], f8, i8)",
+                                      cache=True)(_rematch_infer_only_kernel)
+    _class_aware_rematch_kernel = njit("void(f8[:, :], b1[:], i8[:], f8[:], f8, f8)",
+                                       cache=True)(_class_aware_rematch_kernel)
@@ -27,6 +27,87 @@ def collate_fn(args):
     return batched_image, batched_label, batched_shape, batched_coco_name
 
 
+def collate_fn_infer(args):
+    # Inference 전용 collate_fn. Generator는 label을 사용하지 않으므로 모으지 않고 None을 돌려준다.
+    batched_image = np.array([image for image, _, _, _ in args])
+    batched_shape = np.array([shapes for _, _, shapes, _ in args]).T  # Mandatory!!!
+    batched_coco_name = np.array([coco_name[0] for _, _, _, coco_name in args])
+
+    batched_image = torch.from_numpy(batched_image)
+    batched_shape = torch.from_numpy(batched_shape)
+    # Skip coco name
+
+    return batched_image, None, batched_shape, batched_coco_name
+
+
+_pinned_buffer = None
+
+
+def _pinned_staging_buffer(numel, dtype):
+    # Pinned memory 할당은 느리므로 batch마다 새로 할당하지 않고 하나의 buffer를 재사용한다.
+    # 크기가 부족할 때만 두 배씩 늘려서 다시 할당한다.
+    global _pinned_buffer
+    if _pinned_buffer is None or _pinned_buffer.dtype != dtype or _pinned_buffer.numel() < numel:
+        capacity = numel if _pinned_buffer is None else max(numel, _pinned_buffer.numel() * 2)
+        _pinned_buffer = torch.empty(capacity, dtype=dtype, pin_memory=True)
+    return _pinned_buffer[:numel]
+
+
+def outputs_to_numpy(outputs, ratios=None):
+    # postprocess 결과(이미지별 Tensor 또는 None)를 하나로 합쳐 GPU->CPU 전송을 한 번만 수행한다.
+    # 이미지별 (bboxes, cls, scores) numpy tuple을 돌려주며, 결과가 없는 이미지는 None이다.
+    # ratios가 주어지면 bboxes를 원본 이미지 크기로 되돌린다.
+    rows = []
+    for idx, output in enumerate(outputs):
+        if output is None or len(output) == 0:
+            continue
+        bboxes = output[:, 0:4]
+        if ratios is not None:
+            bboxes = bboxes / ratios[idx]
+        rows.append(torch.cat((bboxes, output[:, 6:7], output[:, 4:5] * output[:, 5:6]), dim=1))
+
+    if len(rows) == 0:
+        return [None for _ in outputs]
+
+    flat = torch.cat(rows, dim=0)
+    if flat.is_cuda:
+        # 재사용하는 pinned staging buffer로 옮긴 다음, buffer가 다시 쓰이므로 pageable 메모리로 복사해 둔다.
+        host = _pinned_staging_buffer(flat.numel(), flat.dtype).view(flat.shape)
+        host.copy_(flat, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        flat = host.numpy().copy()
+    else:
+        flat = flat.numpy()
+
+    results = []
+    offset = 0
+    for output in outputs:
+        if output is None or len(output) == 0:
+            results.append(None)
+            continue
+        item = flat[offset:offset + len(output)]
+        offset += len(output)
+        results.append((item[:, 0:4], item[:, 4].astype(int), item[:, 5]))
+    return results
+
+
+def split_by_class(class_ids, items):
+    # class_id별로 items를 나눈다. 한 번의 stable sort로 나누므로 class 내부의 순서는 유지된다.
+    # {class_id: items[class_ids == class_id]} 형태이며, class_id 오름차순으로 들어있다.
+    order = np.argsort(class_ids, kind='stable')
+    unique_class_ids, split_idxs = np.unique(class_ids[order], return_index=True)
+    return dict(zip(unique_class_ids, np.split(items[order], split_idxs[1:])))
+
+
+def unique_image_names(image_name_arrays):
+    # Scale(또는 batch)별 image id 배열을 한 번에 합쳐 정렬된 unique list로 돌려준다.
+    # 빈 배열은 dtype이 달라 합칠 수 없으므로 제외한다.
+    image_name_arrays = [image_names for image_names in image_name_arrays if len(image_names) > 0]
+    if len(image_name_arrays) == 0:
+        return []
+    return np.unique(np.concatenate(image_name_arrays)).tolist()
+
+
 def xywh2xyminmax(bbox):
     return [bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3]]
 
@@ -38,4 +119,5 @@ def cocoid2classid(coco_id: int):
 
 def classid2cocoid(class_id: int):
     # class_id는 0부터 시작한다.
+    # 단순 offset이므로 numpy 배열을 넘기면 배열 전체를 한 번에 변환한다.
     return class_id + 1
\ No newline at end of file
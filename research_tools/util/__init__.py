@@ -1,2 +1,3 @@
 from .merge_coco import merge_coco
-from .eval_coco import eval_coco
\ No newline at end of file
+from .eval_coco import eval_coco
+from .dump_coco import dump_coco
\ No newline at end of file
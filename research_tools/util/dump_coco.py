@@ -0,0 +1,40 @@
+'''
+    COCO Annotation을 JSON 파일로 저장한다.
+    orjson이 있으면 annotation 단위로 나누어 스트리밍하여 기록하며, 없으면 json.dump를 사용한다.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_coco(coco_result, output_path):
+    if orjson is None:
+        with open(output_path, 'w') as f:
+            # list가 아닌 annotation 모음(CocoAnnotations 등)은 list로 풀어서 저장한다.
+            json.dump(coco_result, f, default=list)
+        return
+
+    # Numpy 값이 남아있어도 그대로 저장할 수 있도록 한다.
+    option = orjson.OPT_SERIALIZE_NUMPY
+    with open(output_path, 'wb') as f:
+        f.write(b'{')
+        for key_idx, (key, value) in enumerate(coco_result.items()):
+            if key_idx > 0:
+                f.write(b',')
+            f.write(orjson.dumps(key) + b':')
+
+            if key != 'annotations':
+                f.write(orjson.dumps(value, option=option))
+                continue
+
+            # 전체 annotation을 하나의 bytes로 만들지 않고 하나씩 기록한다.
+            f.write(b'[')
+            for idx, annotation in enumerate(value):
+                if idx > 0:
+                    f.write(b',')
+                f.write(orjson.dumps(annotation, option=option))
+            f.write(b']')
+        f.write(b'}')
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import torch
+
+from yolox.utils import postprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "research_tools"))
+
+from generator.naiive import postprocess_fast, postprocess_perclass  # noqa: E402
+
+
+def random_predictions(generator, batch_size, num_detections, num_classes):
+    # (cx, cy, w, h, obj_conf, class_conf...) 형식의 model output을 만든다.
+    # NMS로 suppress되는 bbox가 충분히 생기도록 몇 개의 중심 주변에 모아서 만든다.
+    centers = torch.rand((batch_size, max(1, num_detections // 8), 2), generator=generator) * 300
+    center_idx = torch.randint(0, centers.size(1), (batch_size, num_detections), generator=generator)
+    xy = torch.gather(centers, 1, center_idx.unsqueeze(-1).expand(-1, -1, 2))
+    xy = xy + torch.randn((batch_size, num_detections, 2), generator=generator) * 4
+    wh = torch.rand((batch_size, num_detections, 2), generator=generator) * 40 + 10
+    confs = torch.rand((batch_size, num_detections, 1 + num_classes), generator=generator)
+    return torch.cat([xy, wh, confs], dim=-1)
+
+
+def postprocess_perclass_loop(prediction, num_classes, perclass_conf_ious):
+    # 기존 NaiiveAdvancedGenerator의 방식: class마다 class agnostic postprocess를 수행하고 해당 class 결과만 남긴다.
+    outputs = [[] for _ in range(len(prediction))]
+    for class_id in range(num_classes):
+        conf_thresh, iou_thresh = perclass_conf_ious[class_id]
+        per_class_outputs = postprocess(prediction.clone(), num_classes, conf_thresh, iou_thresh, class_agnostic=True)
+        for batch_idx, output in enumerate(per_class_outputs):
+            if output is not None:
+                outputs[batch_idx].append(output[output[:, 6] == class_id])
+    return [torch.cat(output) if len(output) > 0 else prediction.new_zeros((0, 7)) for output in outputs]
+
+
+class TestPostprocessFast(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = torch.Generator().manual_seed(0)
+
+    def assert_same_as_yolox(self, prediction, num_classes, conf_thre, nms_thre):
+        expected = postprocess(prediction.clone(), num_classes, conf_thre, nms_thre, class_agnostic=True)
+        result = postprocess_fast(prediction.clone(), num_classes, conf_thre, nms_thre)
+        self.assertEqual(len(expected), len(result))
+        for expected_detections, detections in zip(expected, result):
+            # yolox는 detection이 없는 이미지에 None을 반환한다.
+            if expected_detections is None:
+                self.assertEqual(detections.shape, (0, 7))
+            else:
+                torch.testing.assert_close(detections, expected_detections, rtol=0, atol=0)
+
+    def test_random_predictions(self):
+        num_classes = 5
+        # yolox postprocess는 detection이 1개인 입력을 squeeze 때문에 처리하지 못하므로 2개부터 비교한다.
+        for batch_size in [1, 4]:
+            for num_detections in [2, 16, 200]:
+                for conf_thre in [0.01, 0.3, 0.9]:
+                    for nms_thre in [0.3, 0.65]:
+                        prediction = random_predictions(self.generator, batch_size, num_detections, num_classes)
+                        self.assert_same_as_yolox(prediction, num_classes, conf_thre, nms_thre)
+
+    def test_conf_thre_boundary(self):
+        # score (obj_conf * class_conf)가 conf_thre와 정확히 같은 bbox는 남고, 바로 아래인 bbox는 버려져야 한다.
+        num_classes = 3
+        prediction = random_predictions(self.generator, 2, 4, num_classes)
+        prediction[:, :, :2] = torch.tensor([[20., 20.], [120., 20.], [20., 120.], [120., 120.]])
+        prediction[:, :, 4:] = 0.1
+        prediction[0, 0, 4], prediction[0, 0, 6] = 0.5, 0.5
+        prediction[0, 1, 4], prediction[0, 1, 7] = 0.5, torch.nextafter(torch.tensor(0.5), torch.tensor(0.))
+        prediction[1, 2, 4], prediction[1, 2, 5] = 0.75, 0.6
+        result = postprocess_fast(prediction.clone(), num_classes, 0.25, 0.45)
+        self.assertEqual([len(detections) for detections in result], [1, 1])
+        self.assert_same_as_yolox(prediction, num_classes, 0.25, 0.45)
+
+    def test_class_agnostic_order(self):
+        # 다른 class의 bbox끼리도 suppress되고, 결과는 class와 무관하게 score 순이어야 한다.
+        num_classes = 3
+        prediction = torch.tensor([[
+            [50., 50., 40., 40., 0.9, 0.2, 0.7, 0.1],
+            [52., 51., 40., 40., 0.9, 0.1, 0.2, 0.95],
+            [200., 200., 30., 30., 0.8, 0.9, 0.05, 0.05],
+            [120., 60., 20., 20., 0.6, 0.1, 0.1, 0.5],
+            [123., 60., 20., 20., 0.9, 0.1, 0.85, 0.1],
+        ]])
+        result = postprocess_fast(prediction.clone(), num_classes, 0.1, 0.45)
+        self.assertEqual(result[0][:, 6].tolist(), [2., 1., 0.])
+        self.assert_same_as_yolox(prediction, num_classes, 0.1, 0.45)
+
+    def test_no_detections(self):
+        num_classes = 4
+        prediction = random_predictions(self.generator, 3, 50, num_classes)
+        prediction[1, :, 4] = 0.
+        self.assert_same_as_yolox(prediction, num_classes, 0.2, 0.45)
+        self.assert_same_as_yolox(prediction, num_classes, 1.1, 0.45)
+
+
+class TestPostprocessPerclass(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = torch.Generator().manual_seed(0)
+
+    def assert_same_as_loop(self, prediction, num_classes, perclass_conf_ious):
+        expected = postprocess_perclass_loop(prediction, num_classes, perclass_conf_ious)
+        conf_thresh_vec = torch.tensor([conf_thresh for conf_thresh, _ in perclass_conf_ious])
+        iou_thresh_vec = torch.tensor([iou_thresh for _, iou_thresh in perclass_conf_ious], dtype=torch.float64)
+        result = postprocess_perclass(prediction.clone(), num_classes, conf_thresh_vec, iou_thresh_vec)
+        self.assertEqual(len(expected), len(result))
+        for expected_detections, detections in zip(expected, result):
+            torch.testing.assert_close(detections, expected_detections, rtol=0, atol=0)
+
+    def random_conf_ious(self, num_classes):
+        # 같은 iou_thresh를 쓰는 class가 생기도록 몇 개의 값 중에서 고른다.
+        conf_threshs = torch.rand(num_classes, generator=self.generator) * 0.5
+        iou_threshs = torch.tensor([0.3, 0.45, 0.65])[torch.randint(0, 3, (num_classes,), generator=self.generator)]
+        return list(zip(conf_threshs.tolist(), iou_threshs.tolist()))
+
+    def test_random_predictions(self):
+        num_classes = 6
+        for batch_size in [1, 4]:
+            for num_detections in [2, 16, 200]:
+                for _ in range(4):
+                    prediction = random_predictions(self.generator, batch_size, num_detections, num_classes)
+                    self.assert_same_as_loop(prediction, num_classes, self.random_conf_ious(num_classes))
+
+    def test_empty_classes(self):
+        # bbox가 하나도 없는 class와, 해당 class의 conf_thresh를 넘는 bbox가 없는 class가 섞여 있어도 같아야 한다.
+        num_classes = 5
+        for num_detections in [2, 16, 200]:
+            prediction = random_predictions(self.generator, 3, num_detections, num_classes)
+            prediction[:, :, 5 + 1] = 0.
+            prediction[:, :, 5 + 3] = 0.
+            perclass_conf_ious = self.random_conf_ious(num_classes)
+            perclass_conf_ious[4] = (1.1, perclass_conf_ious[4][1])
+            self.assert_same_as_loop(prediction, num_classes, perclass_conf_ious)
+
+    def test_tied_scores(self):
+        # obj_conf와 class_conf를 몇 개의 값으로 양자화하여 score가 같은 bbox가 많이 생기도록 한다.
+        num_classes = 4
+        for num_detections in [16, 200]:
+            prediction = random_predictions(self.generator, 2, num_detections, num_classes)
+            prediction[:, :, 4:] = torch.round(prediction[:, :, 4:] * 4) / 4
+            perclass_conf_ious = [(0.25, 0.45), (0.0625, 0.3), (0.25, 0.65), (0.5, 0.45)]
+            self.assert_same_as_loop(prediction, num_classes, perclass_conf_ious)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "research_tools"))
+
+from generator.util import rematch  # noqa: E402
+
+
+def random_bboxes(rng, num_bboxes):
+    # 서로 겹치는 bbox가 충분히 생기도록 몇 개의 중심 주변에 모아서 만든다.
+    centers = rng.uniform(0, 200, (max(1, num_bboxes // 4), 2))
+    xy = centers[rng.integers(0, len(centers), num_bboxes)] + rng.normal(0, 3, (num_bboxes, 2))
+    wh = rng.uniform(5, 40, (num_bboxes, 2))
+    bboxes = np.concatenate([xy, xy + wh], axis=1)
+    return np.round(bboxes)  # 같은 좌표의 bbox도 생기도록 정수로 맞춘다.
+
+
+@unittest.skipUnless(rematch.NUMBA_AVAILABLE, "numba is not installed")
+class TestRematch(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_rematch_infer_only(self):
+        for num_bboxes in [0, 1, 2, 5, 20, 60]:
+            for iou_thresh in [-0.1, 0.0, 0.3, 0.5, 0.9]:
+                for rematch_thresh in [1, 2, 3]:
+                    bboxes = random_bboxes(self.rng, num_bboxes)
+                    np_result = rematch._rematch_infer_only_np(bboxes, iou_thresh, rematch_thresh)
+                    nb_result = rematch._rematch_infer_only_kernel(bboxes, float(iou_thresh), int(rematch_thresh))
+                    for np_value, nb_value in zip(np_result, nb_result):
+                        np.testing.assert_array_equal(np_value, nb_value)
+
+    def test_class_aware_rematch(self):
+        for num_bboxes in [0, 1, 2, 5, 20, 60]:
+            for iou_thresh in [-0.1, 0.0, 0.3, 0.5, 0.9]:
+                flatten_items = np.zeros((num_bboxes, 7), dtype=np.float64)
+                flatten_items[:, :4] = random_bboxes(self.rng, num_bboxes)
+                flatten_items[:, 4] = self.rng.integers(0, 4, num_bboxes)  # class_id
+                flatten_items[:, 5] = self.rng.integers(1, 5, num_bboxes)  # occurance
+                flatten_items[:, 6] = self.rng.integers(0, 3, num_bboxes)  # origin_tag
+                flatten_keep = self.rng.random(num_bboxes) > 0.1
+
+                np_items, np_keep = flatten_items.copy(), flatten_keep.copy()
+                rematch._class_aware_rematch_np(np_items, np_keep, iou_thresh)
+
+                nb_items, nb_keep = flatten_items.copy(), flatten_keep.copy()
+                order, x1_sorted, max_width = rematch._sweep_window(nb_items, iou_thresh)
+                rematch._class_aware_rematch_kernel(nb_items, nb_keep, order.astype(np.int64), x1_sorted,
+                                                    float(max_width), float(iou_thresh))
+
+                np.testing.assert_array_equal(np_keep, nb_keep)
+                np.testing.assert_array_equal(np_items[:, 4:6], nb_items[:, 4:6])
+
+
+if __name__ == "__main__":
+    unittest.main()